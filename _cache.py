@@ -0,0 +1,96 @@
+"""On-disk caches shared by the analysis scripts."""
+import functools
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+
+# Directory (relative to the working directory) holding cached LLM responses
+RESPONSE_CACHE_DIR = ".llm_cache"
+# Seconds a cached LLM response stays valid
+RESPONSE_CACHE_TTL = 7 * 24 * 60 * 60
+# File (inside RESPONSE_CACHE_DIR) holding embeddings of past diffs with their responses
+SEMANTIC_CACHE_FILENAME = "semantic.json"
+# Minimum cosine similarity for a past diff's response to be reused
+SEMANTIC_CACHE_THRESHOLD = 0.92
+
+DIFF_LINE_NUMBERS_RE = re.compile(r'^(@@ )-\d+(?:,\d+)? \+\d+(?:,\d+)?( @@)', re.MULTILINE)
+DIFF_INDEX_LINE_RE = re.compile(r'^index [0-9a-f]+\.\.[0-9a-f]+.*\n', re.MULTILINE)
+WHITESPACE_RE = re.compile(r'[ \t]+')
+
+def write_atomic(path: str, content: str) -> None:
+    """Atomically writes a cache entry so concurrent runs never see partial files."""
+    cache_dir = os.path.dirname(path)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Warning: Could not write cache entry '{path}': {e}")
+
+def cache_key(model_name: str, prompt: str) -> str:
+    """Returns the cache key identifying a request by its model and exact prompt."""
+    payload = json.dumps({"m": model_name, "p": prompt}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def get_response(key: str, ttl: float = RESPONSE_CACHE_TTL) -> str | None:
+    """Returns the cached LLM response for the key, or None if it is missing or older than the TTL."""
+    path = os.path.join(RESPONSE_CACHE_DIR, key)
+    try:
+        if time.time() - os.path.getmtime(path) > ttl:
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def set_response(key: str, content: str) -> None:
+    """Stores an LLM response under the key."""
+    write_atomic(os.path.join(RESPONSE_CACHE_DIR, key), content)
+
+def normalize_diff(diff: str) -> str:
+    """Strips hunk line numbers, blob hashes and repeated whitespace so near-identical diffs compare equal."""
+    diff = DIFF_LINE_NUMBERS_RE.sub(r'\1\2', diff)
+    diff = DIFF_INDEX_LINE_RE.sub('', diff)
+    return WHITESPACE_RE.sub(' ', diff)
+
+@functools.lru_cache(maxsize=None)
+def _semantic_entries() -> list[dict]:
+    """Loads the semantic cache once per process; later additions are kept in this list."""
+    try:
+        with open(os.path.join(RESPONSE_CACHE_DIR, SEMANTIC_CACHE_FILENAME), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+def _is_expired(entry: dict, ttl: float) -> bool:
+    """Whether a semantic cache entry is older than the TTL; entries without a timestamp count as expired."""
+    return time.time() - entry.get("time", 0) > ttl
+
+def find_similar_response(
+    model_name: str,
+    embedding: list[float],
+    threshold: float = SEMANTIC_CACHE_THRESHOLD,
+    ttl: float = RESPONSE_CACHE_TTL,
+) -> str | None:
+    """Returns the response stored for the most similar past diff, if it is at least `threshold` similar."""
+    best_similarity, best_response = threshold, None
+    for entry in _semantic_entries():
+        if entry["model"] != model_name or _is_expired(entry, ttl):
+            continue
+        # OpenAI embeddings are unit length, so the dot product is the cosine similarity
+        similarity = sum(a * b for a, b in zip(embedding, entry["embedding"]))
+        if similarity >= best_similarity:
+            best_similarity, best_response = similarity, entry["response"]
+    return best_response
+
+def add_similar_response(model_name: str, embedding: list[float], response: str, ttl: float = RESPONSE_CACHE_TTL) -> None:
+    """Stores a response under the embedding of its diff, dropping expired entries from the cache."""
+    entries = _semantic_entries()
+    entries[:] = [entry for entry in entries if not _is_expired(entry, ttl)]
+    entries.append({"model": model_name, "embedding": embedding, "response": response, "time": time.time()})
+    write_atomic(os.path.join(RESPONSE_CACHE_DIR, SEMANTIC_CACHE_FILENAME), json.dumps(entries))
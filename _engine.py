@@ -0,0 +1,468 @@
+"""Shared git, OpenAI client and request plumbing for code_check.py and code_conventions_checker.py."""
+import asyncio
+import contextlib
+import functools
+import importlib.util
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import weakref
+from collections import deque
+from dataclasses import dataclass
+from typing import AsyncIterator, Iterator, List, Optional
+import httpx
+import openai
+from openai import AsyncOpenAI
+from openai.types import CompletionUsage
+from openai.types.completion_usage import PromptTokensDetails
+from model_pricing import MODEL_CONTEXT_WINDOWS, MODEL_MAX_PROMPT_TOKENS, MODEL_PRICING
+
+try:
+    import tiktoken
+except ImportError:
+    # Optional: token counts fall back to a character-based estimate
+    tiktoken = None
+
+# Connection pool of the shared client: open connections, idle ones kept for reuse, and request timeout (seconds)
+MAX_CONNECTIONS = 64
+MAX_KEEPALIVE_CONNECTIONS = 32
+REQUEST_TIMEOUT = 60.0
+# Defaults for the request limiter, overridable through OAI_CONCURRENCY / OAI_TOKENS_PER_MINUTE
+DEFAULT_MAX_CONCURRENT_REQUESTS = 8
+DEFAULT_TOKENS_PER_MINUTE = 30_000
+# Length in seconds of the sliding window the token budget applies to
+RATE_LIMIT_WINDOW = 60.0
+# Attempts per request for rate-limit, connection and server errors, with exponential backoff between them
+MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+# Model name that selects the cheapest model able to fit the prompt
+AUTO_MODEL = "auto"
+# Endpoint and completion window of Batch API jobs (billed at half the real-time price)
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+# Model used to embed diffs for the semantic response cache
+EMBEDDING_MODEL = "text-embedding-3-small"
+# File (relative to the working directory) every OpenAI request and response-cache hit is logged to, one JSON object per line
+USAGE_LOG_FILENAME = "llm_usage.jsonl"
+# Average characters per token, used when tiktoken is not installed
+CHARS_PER_TOKEN = 4
+
+DIFF_FILE_SPLIT_RE = re.compile(r'^(?=diff --git )', re.MULTILINE)
+
+@dataclass
+class AnalysisResult:
+    content: str
+    usage: Optional[CompletionUsage]
+
+@dataclass
+class TokenReservation:
+    timestamp: float
+    tokens: int
+
+class RateLimiter:
+    """Caps concurrent OpenAI requests and keeps their token usage under a per-minute budget."""
+
+    def __init__(self, max_concurrent: int, tokens_per_minute: int) -> None:
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._tokens_per_minute = tokens_per_minute
+        self._reservations: deque[TokenReservation] = deque()
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, estimated_tokens: int) -> AsyncIterator[TokenReservation]:
+        """Waits for a request slot and token budget; update the yielded reservation with the actual usage."""
+        async with self._semaphore:
+            while True:
+                now = time.monotonic()
+                while self._reservations and now - self._reservations[0].timestamp >= RATE_LIMIT_WINDOW:
+                    self._reservations.popleft()
+                used_tokens = sum(reservation.tokens for reservation in self._reservations)
+                # An oversized request is let through alone rather than blocking forever
+                if not self._reservations or used_tokens + estimated_tokens <= self._tokens_per_minute:
+                    break
+                await asyncio.sleep(RATE_LIMIT_WINDOW - (now - self._reservations[0].timestamp))
+            reservation = TokenReservation(now, estimated_tokens)
+            self._reservations.append(reservation)
+            yield reservation
+
+# Per event loop, since asyncio primitives and httpx connections are bound to the loop they are used on
+# and each asyncio.run starts a new one
+_rate_limiters: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, RateLimiter]" = weakref.WeakKeyDictionary()
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[str, AsyncOpenAI]]" = weakref.WeakKeyDictionary()
+
+def get_rate_limiter() -> RateLimiter:
+    """Returns the running event loop's request limiter, configured from the environment on first use."""
+    loop = asyncio.get_running_loop()
+    if loop not in _rate_limiters:
+        _rate_limiters[loop] = RateLimiter(
+            max_concurrent=int(os.getenv("OAI_CONCURRENCY", DEFAULT_MAX_CONCURRENT_REQUESTS)),
+            tokens_per_minute=int(os.getenv("OAI_TOKENS_PER_MINUTE", DEFAULT_TOKENS_PER_MINUTE))
+        )
+    return _rate_limiters[loop]
+
+@functools.lru_cache(maxsize=None)
+def git_executable() -> str:
+    """Returns the absolute path of git, searched on PATH once per process."""
+    git = shutil.which("git")
+    if git is None:
+        # Same error as a failed exec, which callers already handle
+        raise FileNotFoundError("'git' executable not found in PATH")
+    return git
+
+def _git_env() -> dict[str, str]:
+    """Returns the environment for git subprocesses, with optional locks (e.g. index refresh) disabled."""
+    # Built per call, so variables set after import (e.g. by load_dotenv) still reach git
+    return {**os.environ, "GIT_OPTIONAL_LOCKS": "0"}
+
+def run_git(args: List[str], check: bool = True, input_data: bytes | None = None) -> subprocess.CompletedProcess:
+    """Runs a git command and returns the completed process with raw (bytes) output."""
+    return subprocess.run(
+        [git_executable(), *args],
+        input=input_data,
+        # Without input, git must not read from (or wait on) the terminal
+        stdin=subprocess.DEVNULL if input_data is None else None,
+        capture_output=True,
+        check=check,
+        env=_git_env()
+    )
+
+def decode_output(data: bytes) -> str:
+    """Decodes git output once as UTF-8, replacing undecodable bytes."""
+    return data.decode("utf-8", errors="replace")
+
+def _diff_args(against_head: bool) -> List[str]:
+    """Returns the git arguments for a diff of the working tree against the index or HEAD."""
+    # Unquoted paths keep the `diff --git a/<path> b/<path>` headers parseable
+    args = ["-c", "core.quotepath=false", "diff"]
+    if against_head:
+        args += ["--no-ext-diff", "HEAD"]
+    return args
+
+def _check_diff_returncode(args: List[str], returncode: int, stderr: bytes) -> None:
+    """Raises if git diff failed; exit code 1 only signals that differences were found."""
+    if returncode > 1:
+        cmd_str = ' '.join(["git", *args]) # For error message
+        error_message = f"Error running '{cmd_str}' (return code {returncode}):"
+        if stderr:
+            error_message += f"\nGit stderr: {decode_output(stderr).strip()}"
+        print(error_message)
+        raise RuntimeError(f"Git command '{cmd_str}' failed with code {returncode}")
+
+def get_diff(against_head: bool = False) -> str:
+    """
+    Get the git diff of the working tree, either against the index or (with against_head) against HEAD.
+    Includes a workaround for git diff potentially returning exit code 0 even with output.
+    """
+    args = _diff_args(against_head)
+    try:
+        process = run_git(args, check=False) # Manually check return codes
+    except FileNotFoundError:
+        print("Error: 'git' command not found. Ensure git is installed and in your PATH.")
+        raise
+    _check_diff_returncode(args, process.returncode, process.stderr)
+
+    # If exit code is 0 or 1, rely on stdout content.
+    # If stdout is empty (or only whitespace), then no diff.
+    stdout = decode_output(process.stdout)
+    return stdout if stdout.strip() else ""
+
+def iter_diff_files(against_head: bool = False) -> Iterator[str]:
+    """
+    Streams the git diff (see get_diff), yielding each file's section as soon as git has written it.
+    Unlike get_diff, the whole diff is never held in memory at once.
+    """
+    args = _diff_args(against_head)
+    # stderr goes to a file rather than a pipe: git blocks once an unread pipe fills up (e.g. with
+    # line-ending warnings), which would deadlock while stdout is still being read
+    with tempfile.TemporaryFile() as stderr_file:
+        try:
+            process = subprocess.Popen(
+                [git_executable(), *args], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=stderr_file,
+                env=_git_env()
+            )
+        except FileNotFoundError:
+            print("Error: 'git' command not found. Ensure git is installed and in your PATH.")
+            raise
+
+        with process:
+            lines: List[bytes] = []
+            for line in process.stdout:
+                # Body lines start with ' ', '+' or '-', so only file headers begin with `diff --git`
+                if line.startswith(b"diff --git ") and lines:
+                    yield decode_output(b"".join(lines))
+                    lines = []
+                lines.append(line)
+        stderr_file.seek(0)
+        stderr = stderr_file.read()
+    _check_diff_returncode(args, process.returncode, stderr)
+    if b"".join(lines).strip():
+        yield decode_output(b"".join(lines))
+
+def split_diff_by_file(diff: str) -> List[str]:
+    """Splits a diff into one section per file, each starting with its `diff --git` header."""
+    return [section for section in DIFF_FILE_SPLIT_RE.split(diff) if section]
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding(model_name: str) -> Optional["tiktoken.Encoding"]:
+    """Returns the tiktoken encoding for the model, loaded once per process, or None if tiktoken cannot provide it."""
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # e.g. the BPE file cannot be downloaded offline; the failure is cached, so this is not retried per text
+        print(f"Warning: Could not load tiktoken encoding for {model_name}, estimating token counts instead: {e}")
+        return None
+
+@functools.lru_cache(maxsize=256)
+def count_tokens(text: str, model_name: str) -> int:
+    """Counts the tokens of the text for the model, or estimates them if tiktoken is unavailable."""
+    # Cached because the same texts (file diffs, static prompt parts) are counted repeatedly within a run
+    encoding = _get_encoding(model_name)
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN
+    return len(encoding.encode(text))
+
+def pick_model(prompt: str, max_tokens: int, prompt_tokens: int | None = None) -> str:
+    """
+    Returns the cheapest priced model adequate for the prompt: its context window fits the prompt plus the
+    completion, and the prompt is within the model's MODEL_MAX_PROMPT_TOKENS, if it has one.
+    """
+    if prompt_tokens is None:
+        prompt_tokens = count_tokens(prompt, "gpt-4o")
+    required_tokens = prompt_tokens + max_tokens
+    for model_name in sorted(MODEL_PRICING, key=lambda name: MODEL_PRICING[name].prompt):
+        if prompt_tokens > MODEL_MAX_PROMPT_TOKENS.get(model_name, prompt_tokens):
+            continue
+        if MODEL_CONTEXT_WINDOWS.get(model_name, 0) >= required_tokens:
+            return model_name
+    raise ValueError(f"No known model has a context window for {required_tokens} tokens")
+
+def resolve_api_key(api_key: str | None) -> str:
+    """Returns the given API key, falling back to the OPENAI_API_KEY environment variable."""
+    api_key = api_key or os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OPENAI_API_KEY not found in environment variables or provided via --api-key argument")
+    return api_key
+
+def make_client(api_key: str) -> AsyncOpenAI:
+    """
+    Returns the OpenAI client for the API key, shared within the running event loop so its connections
+    (and TLS sessions) are reused.
+    """
+    clients = _clients.setdefault(asyncio.get_running_loop(), {})
+    if api_key not in clients:
+        clients[api_key] = _create_client(api_key)
+    return clients[api_key]
+
+def _create_client(api_key: str) -> AsyncOpenAI:
+    """Creates an OpenAI client with its own HTTP connection pool."""
+    # HTTP/2 multiplexes concurrent requests over one connection, but needs the optional `h2` package
+    http_client = httpx.AsyncClient(
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS),
+        timeout=REQUEST_TIMEOUT
+    )
+    try:
+        # send() retries transient errors itself, so the SDK's own retries would multiply the attempts
+        return AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+    except Exception as e:
+        raise ConnectionError(f"Failed to initialize OpenAI client: {e}")
+
+async def send(
+    client: AsyncOpenAI,
+    model_name: str,
+    prompt: str,
+    max_tokens: int,
+    temperature: float | None = None,
+    echo: bool = False,
+    prompt_tokens: int | None = None,
+) -> AnalysisResult:
+    """
+    Sends the prompt as a streamed chat completion, optionally echoing tokens to stdout as they arrive.
+    Callers that already know the prompt's token count can pass it to skip re-tokenizing the prompt.
+    """
+    if prompt_tokens is None:
+        prompt_tokens = count_tokens(prompt, model_name)
+    # Requests reserve their prompt plus the maximum completion, as OpenAI counts them against the limit
+    estimated_tokens = prompt_tokens + max_tokens
+    async with get_rate_limiter().reserve(estimated_tokens) as reservation:
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                result = await _stream_completion(client, model_name, prompt, max_tokens, temperature, echo)
+                break
+            except (openai.RateLimitError, openai.APIConnectionError, openai.APIStatusError) as e:
+                if attempt == MAX_ATTEMPTS - 1 or not _is_retryable(e):
+                    raise
+                delay = _retry_delay(e, attempt)
+                print(f"Warning: OpenAI request failed ({e}), retrying in {delay:.1f}s...")
+                await asyncio.sleep(delay)
+        if result.usage:
+            reservation.tokens = result.usage.total_tokens
+    log_usage(model_name, result.usage)
+    return result
+
+def _is_retryable(error: openai.APIError) -> bool:
+    """Whether the error is transient: rate limiting, a connection problem or a server-side failure."""
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+def _retry_delay(error: openai.APIError, attempt: int) -> float:
+    """Seconds to wait before the next attempt, honoring a Retry-After header when the server sent one."""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(RETRY_MAX_DELAY, float(retry_after))
+        except ValueError:
+            pass # HTTP-date form, fall back to backoff
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt + random.random())
+
+async def _stream_completion(
+    client: AsyncOpenAI,
+    model_name: str,
+    prompt: str,
+    max_tokens: int,
+    temperature: float | None,
+    echo: bool,
+) -> AnalysisResult:
+    """Streams a single chat completion and collects its content and usage."""
+    options = {"temperature": temperature} if temperature is not None else {}
+    stream = await client.chat.completions.create(
+        model=model_name,
+        max_tokens=max_tokens,
+        messages=[{
+            "role": "user",
+            "content": prompt
+        }],
+        stream=True,
+        stream_options={"include_usage": True}, # Final chunk carries the token usage
+        **options
+    )
+
+    content_parts = []
+    usage = None
+    async for chunk in stream:
+        if chunk.usage:
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            content_parts.append(delta)
+            if echo:
+                sys.stdout.write(delta)
+                sys.stdout.flush()
+    if echo:
+        print()
+    return AnalysisResult("".join(content_parts), usage)
+
+async def send_many(
+    client: AsyncOpenAI,
+    model_name: str,
+    prompts: List[str],
+    max_tokens: int,
+    temperature: float | None = None,
+) -> List[AnalysisResult]:
+    """Sends the prompts concurrently, within the limits of the shared rate limiter, keeping their order."""
+    return list(await asyncio.gather(*(send(client, model_name, prompt, max_tokens, temperature) for prompt in prompts)))
+
+async def submit_batch(
+    client: AsyncOpenAI,
+    model_name: str,
+    prompts: List[str],
+    max_tokens: int,
+    temperature: float | None = None,
+) -> str:
+    """
+    Submits the prompts as one Batch API job and returns its ID; results arrive within the completion window.
+    Each request's `custom_id` is the index of its prompt.
+    """
+    options = {"temperature": temperature} if temperature is not None else {}
+    rows = [
+        json.dumps({
+            "custom_id": str(index),
+            "method": "POST",
+            "url": BATCH_ENDPOINT,
+            "body": {
+                "model": model_name,
+                "max_tokens": max_tokens,
+                "messages": [{"role": "user", "content": prompt}],
+                **options
+            }
+        })
+        for index, prompt in enumerate(prompts)
+    ]
+    batch_file = await client.files.create(
+        file=("batch.jsonl", "\n".join(rows).encode("utf-8")),
+        purpose="batch"
+    )
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window=BATCH_COMPLETION_WINDOW
+    )
+    return batch.id
+
+async def embed(client: AsyncOpenAI, text: str) -> list[float]:
+    """Returns the embedding of the text."""
+    response = await client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+    return response.data[0].embedding
+
+def cached_prompt_tokens(usage: CompletionUsage) -> int:
+    """Returns how many prompt tokens were served from OpenAI's automatic prompt cache."""
+    details = usage.prompt_tokens_details
+    return (details.cached_tokens or 0) if details else 0
+
+def calculate_cost(usage: CompletionUsage, model_name: str) -> float:
+    """Calculates the cost of usage in Dollar based on token counts."""
+    pricing = MODEL_PRICING.get(model_name, MODEL_PRICING["gpt-4o"])
+    prompt_cost = (usage.prompt_tokens / 1_000_000) * pricing.prompt
+    completion_cost = (usage.completion_tokens / 1_000_000) * pricing.completion
+    total_cost = prompt_cost + completion_cost
+    # Round the final result to 4 decimal places before returning
+    return round(total_cost, 6)
+
+def log_usage(model_name: str, usage: CompletionUsage | None, source: str = "api") -> None:
+    """
+    Appends a request's token usage and cost to the usage log.
+    Responses served from a local cache are logged with their source and no tokens, so cache hit rates can be measured.
+    """
+    record = {
+        "time": time.time(),
+        "model": model_name,
+        "source": source,
+        "prompt": usage.prompt_tokens if usage else 0,
+        "completion": usage.completion_tokens if usage else 0,
+        "cached": cached_prompt_tokens(usage) if usage else 0,
+        "cost": calculate_cost(usage, model_name) if usage else 0.0,
+    }
+    try:
+        with open(USAGE_LOG_FILENAME, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        print(f"Warning: Could not write usage log '{USAGE_LOG_FILENAME}': {e}")
+
+def merge_results(results: List[AnalysisResult]) -> AnalysisResult:
+    """Combines the results of a diff analyzed in parts into one, summing their token usage."""
+    content = "\n\n".join(result.content for result in results)
+    usages = [result.usage for result in results if result.usage]
+    if not usages:
+        return AnalysisResult(content, None)
+    usage = CompletionUsage(
+        prompt_tokens=sum(usage.prompt_tokens for usage in usages),
+        completion_tokens=sum(usage.completion_tokens for usage in usages),
+        total_tokens=sum(usage.total_tokens for usage in usages),
+        prompt_tokens_details=PromptTokensDetails(cached_tokens=sum(cached_prompt_tokens(usage) for usage in usages))
+    )
+    return AnalysisResult(content, usage)
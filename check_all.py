@@ -0,0 +1,77 @@
+#! /usr/bin/env python3
+import asyncio
+import argparse
+import subprocess
+from dotenv import load_dotenv
+from _engine import AnalysisResult, cached_prompt_tokens, make_client, resolve_api_key, send
+import code_check
+import code_conventions_checker
+
+async def check_all(
+    api_key: str = None,
+    model_name: str = "gpt-4o",
+    use_cache: bool = True,
+) -> list[AnalysisResult] | str:
+    """Runs the diff review and the convention check concurrently on a single git diff and OpenAI client."""
+    api_key = resolve_api_key(api_key)
+    client = make_client(api_key)
+
+    print("Collecting diff context...")
+    analysis = await asyncio.to_thread(code_check.collect_diff_context, use_cache)
+    if not analysis.diff_content:
+        return "No changes detected by git diff."
+
+    print("Creating LLM prompts...")
+    review_prompt = code_check.create_llm_prompt(analysis, debug=False)
+    conventions_prompt = code_conventions_checker.create_llm_prompt(analysis.diff_content)
+
+    print(f"Sending requests to OpenAI model: {model_name}...")
+    return list(await asyncio.gather(
+        send(client, model_name, review_prompt, max_tokens=4096),
+        send(client, model_name, conventions_prompt, max_tokens=2000, temperature=0.1),
+    ))
+
+if __name__ == "__main__":
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(
+        description="Run the diff review and the code convention check in one process using an OpenAI LLM"
+    )
+    parser.add_argument(
+        "--api-key",
+        help="OpenAI API key (defaults to OPENAI_API_KEY env var)"
+    )
+    parser.add_argument(
+        "--model",
+        default="gpt-4o",
+        help="OpenAI model name to use for both analyses"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always read file contents from git instead of the on-disk cache"
+    )
+
+    args = parser.parse_args()
+
+    try:
+        results = asyncio.run(check_all(api_key=args.api_key, model_name=args.model, use_cache=not args.no_cache))
+        if isinstance(results, str):
+            print(results)
+        else:
+            review, conventions = results
+            print("\n=== AI Analysis ===")
+            print(review.content)
+            print("\n=== AI Code Convention Analysis ===")
+            print(conventions.content)
+            usages = [result.usage for result in results if result.usage]
+            if usages:
+                print("\n=== Cost of Usage ===")
+                print(f"  Prompt Tokens: {sum(usage.prompt_tokens for usage in usages)}")
+                print(f"  Cached Prompt Tokens: {sum(cached_prompt_tokens(usage) for usage in usages)}")
+                print(f"  Completion Tokens: {sum(usage.completion_tokens for usage in usages)}")
+                print(f"  Cost in Dollar: {round(sum(code_check.calculate_cost(usage, model_name=args.model) for usage in usages), 6)}")
+    except (ValueError, ConnectionError, RuntimeError, subprocess.CalledProcessError) as e:
+        print(f"\nAn error occurred: {e}")
+    except Exception as e:
+        print(f"\nAn unexpected error occurred: {e}")
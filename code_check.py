@@ -1,17 +1,50 @@
 #! /usr/bin/env python3
+import asyncio
+import functools
+import hashlib
+import io
+import string
 import subprocess
 import os
+import re
 from typing import Dict, List
-from openai import OpenAI
-from openai.types import CompletionUsage
-from openai.types.chat import ChatCompletion
 from dataclasses import dataclass
 import argparse
 from dotenv import load_dotenv
-from model_pricing import MODEL_PRICING
+from _cache import write_atomic
+from _engine import (
+    AnalysisResult, cached_prompt_tokens, calculate_cost, count_tokens, decode_output, get_diff, make_client, merge_results, resolve_api_key, run_git, send,
+    send_many, split_diff_by_file,
+)
 
 load_dotenv()
 
+# Directory inside the repository's git dir where file contents are cached per commit
+FILE_CACHE_DIRNAME = "ai-workflow-cache"
+
+# Files longer than this are trimmed to the lines surrounding their diff hunks
+FULL_CONTEXT_MAX_LINES = 500
+# Lines of file context kept above and below each hunk of a trimmed file
+HUNK_CONTEXT_LINES = 50
+# Tokens of diff and file context sent per request; larger diffs are split across parallel requests
+PROMPT_TOKEN_BUDGET = 8000
+# Leading characters inspected for NUL bytes when detecting binary files
+BINARY_SNIFF_LENGTH = 8192
+
+# Paths with special characters (quotes, backslashes, control characters) are C-quoted by git.
+# Each path pattern captures a (C-quoted, plain) group pair.
+DIFF_FILE_HEADER_RE = re.compile(
+    r'^diff --git (?:"a/(?:[^"\\]|\\.)*"|a/.*) (?:"b/((?:[^"\\]|\\.)*)"|b/(.*))$', re.MULTILINE
+)
+# Header of a file that was not renamed or copied: both halves name the same path, which
+# disambiguates paths containing " b/"
+DIFF_SAME_PATH_HEADER_RE = re.compile(r'diff --git (?:"a/((?:[^"\\]|\\.)*)" "b/\1"|a/(.*) b/\2)')
+DIFF_RENAME_TO_RE = re.compile(r'^(?:rename|copy) to (?:"((?:[^"\\]|\\.)*)"|(.*))$', re.MULTILINE)
+# git appends a tab to ---/+++ paths containing spaces
+DIFF_NEW_PATH_RE = re.compile(r'^\+\+\+ (?:"b/((?:[^"\\]|\\.)*)"|b/(.*?))\t?$', re.MULTILINE)
+GIT_QUOTE_ESCAPES = {"a": 7, "b": 8, "t": 9, "n": 10, "v": 11, "f": 12, "r": 13, '"': 34, "\\": 92}
+DIFF_HUNK_HEADER_RE = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+\d+(?:,\d+)? @@')
+
 @dataclass
 class FileContext:
     path: str
@@ -25,66 +58,269 @@ class DiffAnalysis:
 
 def get_git_diff() -> str:
     """Get the git diff for the specified commit range."""
-    result = subprocess.run(
-        ["git", "diff"],
-        capture_output=True,
-        text=True,
-        check=True
-    )
-    return result.stdout
+    return get_diff()
+
+def _unquote_git_path(quoted: str) -> str:
+    """Decodes a path C-quoted by git, whose non-ASCII bytes are written as octal escapes."""
+    path = bytearray()
+    i = 0
+    while i < len(quoted):
+        if quoted[i] != "\\":
+            path += quoted[i].encode("utf-8")
+            i += 1
+        elif quoted[i + 1] in GIT_QUOTE_ESCAPES:
+            path.append(GIT_QUOTE_ESCAPES[quoted[i + 1]])
+            i += 2
+        else:
+            path.append(int(quoted[i + 1:i + 4], 8))
+            i += 4
+    return decode_output(bytes(path))
+
+def _matched_path(match: re.Match) -> str:
+    """Returns the path captured by one of the (C-quoted, plain) group pairs of a path pattern."""
+    quoted_path, path = match.groups()
+    return _unquote_git_path(quoted_path) if quoted_path is not None else path
+
+def diff_section_path(file_diff: str) -> str | None:
+    """Returns the (post-image) file path of one file's section of a diff, as split by split_diff_by_file."""
+    header, _, rest = file_diff.partition("\n")
+    same_path = DIFF_SAME_PATH_HEADER_RE.fullmatch(header)
+    if same_path:
+        return _matched_path(same_path)
+    # A rename's header is ambiguous if a path contains " b/", so the path is taken from the
+    # extended header lines, which precede the first hunk
+    extended_header = rest.partition("\n@@")[0]
+    for pattern in (DIFF_RENAME_TO_RE, DIFF_NEW_PATH_RE):
+        match = pattern.search(extended_header)
+        if match:
+            return _matched_path(match)
+    header_match = DIFF_FILE_HEADER_RE.match(header)
+    return _matched_path(header_match) if header_match else None
 
-def get_changed_files() -> List[str]:
-    """Get list of files changed in the specified commit range."""
+def get_changed_files(diff: str) -> List[str]:
+    """Get list of files changed in the diff, parsed from its `diff --git` headers."""
+    return [file_path for file_diff in split_diff_by_file(diff) if (file_path := diff_section_path(file_diff))]
+
+def _read_files_batch(file_paths: List[str], commit: str) -> Dict[str, str]:
+    """Read several files at a specific commit using a single `git cat-file --batch` process."""
+    # Newlines delimit the batch input, so such paths cannot be requested
+    unreadable = [file_path for file_path in file_paths if "\n" in file_path]
+    if unreadable:
+        print(f"Warning: Skipping content for paths containing newlines: {unreadable}")
+        contents = _read_files_batch([file_path for file_path in file_paths if "\n" not in file_path], commit)
+        return {file_path: contents.get(file_path, "") for file_path in file_paths}
+    if not file_paths:
+        return {}
+    batch_input = "".join(f"{commit}:{file_path}\n" for file_path in file_paths)
     try:
-        result = subprocess.run(
-            ["git", "diff", "--name-only"],
-            capture_output=True,
-            text=True,
-            check=True
-        )
+        result = run_git(["cat-file", "--batch"], input_data=batch_input.encode("utf-8"))
     except subprocess.CalledProcessError as e:
-        print(f"Error running git diff --name-only: {e}")
-        raise # Re-raise the exception after printing
-    return result.stdout.splitlines()
+        print(f"Warning: Could not get file contents at {commit}: {e}")
+        return {file_path: "" for file_path in file_paths}
+
+    # Output is framed per requested object: "<sha> <type> <size>\n<content>\n",
+    # or "<object> missing\n" / "<object> ambiguous\n" if it cannot be resolved
+    output = result.stdout
+    contents = {}
+    offset = 0
+    for file_path in file_paths:
+        header_end = output.index(b"\n", offset)
+        header = output[offset:header_end].split()
+        offset = header_end + 1
+        content = ""
+        # The object name echoed back for missing/ambiguous paths may itself contain spaces
+        if header[-1] not in (b"missing", b"ambiguous"):
+            size = int(header[2])
+            if header[1] == b"blob":
+                content = decode_output(output[offset:offset + size])
+            offset += size + 1
+        if not content:
+            # File might not exist at this commit (new file) or might be binary
+            print(f"Warning: Could not get content for {file_path} at {commit}. Might be a new or binary file.")
+        contents[file_path] = content
+    return contents
+
+def _resolve_file_cache(commit: str) -> tuple[str, str] | None:
+    """Returns the resolved commit SHA and the cache directory, or None outside a usable repository."""
+    try:
+        result = run_git(["rev-parse", "--git-dir", commit])
+    except subprocess.CalledProcessError:
+        return None
+    git_dir, commit_sha = decode_output(result.stdout).splitlines()
+    return commit_sha, os.path.join(git_dir, FILE_CACHE_DIRNAME)
+
+def _file_cache_path(cache_dir: str, commit_sha: str, file_path: str) -> str:
+    """Returns the cache file location for a file at a resolved commit."""
+    key = hashlib.sha256(f"{commit_sha}:{file_path}".encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, key)
 
-def get_file_content(file_path: str, commit: str = "HEAD") -> str:
+def get_file_contents(file_paths: List[str], commit: str = "HEAD", use_cache: bool = True) -> Dict[str, str]:
+    """Get contents of several files at a specific commit, served from the on-disk cache when possible."""
+    if not file_paths:
+        return {}
+    cache = _resolve_file_cache(commit) if use_cache else None
+    if cache is None:
+        return _read_files_batch(file_paths, commit)
+
+    # Contents at a resolved commit never change, so cached entries are always valid
+    commit_sha, cache_dir = cache
+    contents = {}
+    missing = []
+    for file_path in file_paths:
+        try:
+            with open(_file_cache_path(cache_dir, commit_sha, file_path), 'r', encoding='utf-8') as f:
+                contents[file_path] = f.read()
+        except OSError:
+            missing.append(file_path)
+
+    if missing:
+        fetched = _read_files_batch(missing, commit_sha)
+        for file_path, content in fetched.items():
+            if content:
+                write_atomic(_file_cache_path(cache_dir, commit_sha, file_path), content)
+            contents[file_path] = content
+    return contents
+
+def get_file_content(file_path: str, commit: str = "HEAD", use_cache: bool = True) -> str:
     """Get content of a file at a specific commit."""
+    return get_file_contents([file_path], commit, use_cache)[file_path]
+
+def get_attribute_skipped_files(file_paths: List[str]) -> set[str]:
+    """Get the files marked `binary` or `linguist-generated` in .gitattributes."""
+    if not file_paths:
+        return set()
+    # Paths are piped NUL-separated rather than passed as arguments, which large diffs would overflow
+    paths_input = "".join(f"{file_path}\0" for file_path in file_paths)
     try:
-        # Ensure file paths with spaces are handled correctly (though git usually doesn't need quotes here)
-        result = subprocess.run(
-            ["git", "show", f"{commit}:{file_path}"],
-            capture_output=True,
-            text=True,
-            check=True,
-            errors='ignore' # Ignore decoding errors for binary files, etc.
+        result = run_git(
+            ["check-attr", "--stdin", "-z", "binary", "linguist-generated"], input_data=paths_input.encode("utf-8")
         )
-        return result.stdout
-    except subprocess.CalledProcessError:
-        # File might not exist at this commit (new file) or might be binary
-        print(f"Warning: Could not get content for {file_path} at {commit}. Might be a new or binary file.")
-        return ""
+    except subprocess.CalledProcessError as e:
+        print(f"Warning: Could not read git attributes: {e}")
+        return set()
+
+    # Output is a flat sequence of "<path>\0<attribute>\0<value>\0" records
+    fields = decode_output(result.stdout).split("\0")
+    skipped = set()
+    for path, _, value in zip(fields[0::3], fields[1::3], fields[2::3]):
+        if value in ("set", "true"):
+            skipped.add(path)
+    return skipped
 
-def collect_diff_context() -> DiffAnalysis:
+def parse_diff_hunks(diff: str) -> Dict[str, List[tuple[int, int]]]:
+    """Parses the pre-image `(start, count)` line range of every hunk in the diff, per file."""
+    hunks = {}
+    for file_diff in split_diff_by_file(diff):
+        file_path = diff_section_path(file_diff)
+        if file_path is None:
+            continue
+        current_hunks = hunks.setdefault(file_path, [])
+        for line in file_diff.splitlines():
+            hunk_match = DIFF_HUNK_HEADER_RE.match(line)
+            if hunk_match:
+                count = hunk_match.group(2)
+                current_hunks.append((int(hunk_match.group(1)), int(count) if count is not None else 1))
+    return hunks
+
+def extract_hunk_windows(content: str, hunks: List[tuple[int, int]]) -> str:
+    """Reduces large file content to the lines around its diff hunks, marking omitted ranges."""
+    lines = content.splitlines(keepends=True)
+    if len(lines) <= FULL_CONTEXT_MAX_LINES or not hunks:
+        return content
+
+    # Merge the (1-based, inclusive) windows around each hunk
+    windows = []
+    for start, count in sorted(hunks):
+        low = max(1, start - HUNK_CONTEXT_LINES)
+        high = min(len(lines), start + count + HUNK_CONTEXT_LINES)
+        if windows and low <= windows[-1][1] + 1:
+            windows[-1] = (windows[-1][0], max(windows[-1][1], high))
+        else:
+            windows.append((low, high))
+
+    buf = io.StringIO()
+    next_line = 1
+    for low, high in windows:
+        if low > next_line:
+            buf.write(f"... [lines {next_line}-{low - 1} omitted] ...\n")
+        buf.writelines(lines[low - 1:high])
+        next_line = high + 1
+    if next_line <= len(lines):
+        buf.write(f"... [lines {next_line}-{len(lines)} omitted] ...\n")
+    return buf.getvalue()
+
+def get_existing_files(file_paths: List[str]) -> set[str]:
+    """Get the given (git-style, `/`-separated) paths that exist in the working tree, scanning each parent directory once."""
+    existing = set()
+    for parent in {path.rpartition("/")[0] for path in file_paths}:
+        try:
+            with os.scandir(parent or ".") as entries:
+                existing.update(f"{parent}/{entry.name}" if parent else entry.name for entry in entries)
+        except OSError:
+            # Directory was removed along with the files in it
+            continue
+    return existing.intersection(file_paths)
+
+def collect_diff_context(use_cache: bool = True) -> DiffAnalysis:
     """Collect all context needed for diff analysis."""
-    files = get_changed_files()
+    # The file list is parsed from the diff itself, so git walks the working tree only once
     diff = get_git_diff()
+    files = get_changed_files(diff)
+    skipped_by_attributes = get_attribute_skipped_files(files)
+    existing_files = get_existing_files(files)
 
-    file_contexts = {}
+    # Check if the file exists locally before trying to get git content
+    # This helps avoid errors if a file was deleted in the changes
+    paths = []
     for file_path in files:
-        # Check if the file exists locally before trying to get git content
-        # This helps avoid errors if a file was deleted in the changes
-        if os.path.exists(file_path) or 'deleted file' not in diff: # Basic check
-             content = get_file_content(file_path)
-             if content: # Only add context if content was retrieved
-                file_contexts[file_path] = FileContext(file_path, content)
+        if file_path in skipped_by_attributes:
+            print(f"Skipping content fetch for binary or generated file: {file_path}")
+        elif file_path in existing_files or 'deleted file' not in diff: # Basic check
+            paths.append(file_path)
         else:
-             print(f"Skipping content fetch for potentially deleted file: {file_path}")
+            print(f"Skipping content fetch for potentially deleted file: {file_path}")
 
+    # Fetch every file in one git process instead of spawning one `git show` per file
+    contents = get_file_contents(paths, use_cache=use_cache)
+
+    # Content comes from HEAD, so hunks are located by their pre-image line numbers
+    hunks = parse_diff_hunks(diff)
+    file_contexts = {}
+    for file_path, content in contents.items():
+        if not content: # Only add context if content was retrieved
+            continue
+        if "\0" in content[:BINARY_SNIFF_LENGTH]:
+            print(f"Skipping binary file content: {file_path}")
+            continue
+        file_contexts[file_path] = FileContext(file_path, extract_hunk_windows(content, hunks.get(file_path, [])))
 
     return DiffAnalysis(files, diff, file_contexts)
 
+def partition_diff_analysis(analysis: DiffAnalysis, model_name: str, token_budget: int = PROMPT_TOKEN_BUDGET) -> List[DiffAnalysis]:
+    """Splits the analysis by file into groups whose diff and file context fit the token budget."""
+    groups = []
+    files, diffs, file_contexts, tokens = [], [], {}, 0
+    for file_diff in split_diff_by_file(analysis.diff_content):
+        file_path = diff_section_path(file_diff)
+        ctx = analysis.file_contexts.get(file_path)
+        file_tokens = count_tokens(file_diff, model_name) + (count_tokens(ctx.content, model_name) if ctx else 0)
+        # A single file over the budget still gets a group of its own
+        if diffs and tokens + file_tokens > token_budget:
+            groups.append(DiffAnalysis(files, "".join(diffs), file_contexts))
+            files, diffs, file_contexts, tokens = [], [], {}, 0
+        if file_path:
+            files.append(file_path)
+        if ctx:
+            file_contexts[file_path] = ctx
+        diffs.append(file_diff)
+        tokens += file_tokens
+    if diffs:
+        groups.append(DiffAnalysis(files, "".join(diffs), file_contexts))
+    return groups
+
+@functools.lru_cache(maxsize=None)
 def load_text_from_file(filename: str) -> str:
-    """Loads the text from the specified text file."""
+    """Loads the text from the specified text file. Each file is read only once per process."""
     # Try finding the file relative to the script first
     script_dir = os.path.dirname(os.path.abspath(__file__))
     file_path = os.path.join(script_dir, filename)
@@ -113,77 +349,93 @@ def create_llm_prompt(analysis: DiffAnalysis, debug: bool) -> str:
     """Creates a concise LLM prompt focused *only* on convention checking."""
 
     # Load the structured conventions from the file
-    # Error handling for file loading is done within load_conventions_from_file
+    # Error handling for file loading is done within load_text_from_file
     # Exception will propagate up if file is not found or unreadable
-    prompt_instructions = load_text_from_file("llm_prompt.txt")
-    code_conventions_text = load_text_from_file("code_conventions.txt")
-
-    files_content = "\n\n".join(
-        # Only include context if content was successfully retrieved
-        f"--- {ctx.path} ---\n{ctx.content}"
-        for ctx in analysis.file_contexts.values() if ctx.content
-    )
-    if not files_content:
-        files_content = "[No relevant file context could be retrieved from HEAD]"
-
-    # Combine loaded conventions, instructions, diff, and context
-    full_prompt = code_conventions_text + "\n\n" + prompt_instructions
+    prompt_segments = _prompt_segments()
 
-    # Handle potentially empty diff content gracefully in the format string
-    diff_content_to_format = analysis.diff_content if analysis.diff_content else "[No diff content available]"
     if debug:
         # In debug mode, use a hardcoded prompt for testing
         return load_text_from_file("hardcode_instruction.txt")
-    return full_prompt.format(diff=diff_content_to_format, files_content=files_content)
 
-def analyze_diff(
+    # Handle potentially empty diff content gracefully in the template
+    diff_content = analysis.diff_content if analysis.diff_content else "[No diff content available]"
+
+    # Write conventions, instructions, diff, and context into a single buffer so the
+    # (potentially multi-MB) file contents are copied only once
+    buf = io.StringIO()
+    for literal_text, field_name in prompt_segments:
+        buf.write(literal_text)
+        if field_name == "diff":
+            buf.write(diff_content)
+        elif field_name == "files_content":
+            _write_files_content(buf, analysis)
+    return buf.getvalue()
+
+@functools.lru_cache(maxsize=None)
+def _prompt_segments() -> tuple[tuple[str, str | None], ...]:
+    """Parses the prompt template once into (literal text, field name) pairs, with the conventions prepended."""
+    prompt_instructions = load_text_from_file("llm_prompt.txt")
+    code_conventions_text = load_text_from_file("code_conventions.txt")
+    segments = [(literal_text, field_name) for literal_text, field_name, _, _ in string.Formatter().parse(prompt_instructions)]
+    segments[0] = (code_conventions_text + "\n\n" + segments[0][0], segments[0][1])
+    return tuple(segments)
+
+def _write_files_content(buf: io.StringIO, analysis: DiffAnalysis) -> None:
+    """Writes the retrieved file contents, separated by path headers, into the prompt buffer."""
+    separator = ""
+    for ctx in analysis.file_contexts.values():
+        # Only include context if content was successfully retrieved
+        if not ctx.content:
+            continue
+        buf.write(f"{separator}--- {ctx.path} ---\n")
+        buf.write(ctx.content)
+        separator = "\n\n"
+    if not separator:
+        buf.write("[No relevant file context could be retrieved from HEAD]")
+
+async def analyze_diff(
     api_key: str = None,
     model_name: str = "gpt-4o", # Default to gpt-4o, can be changed
     debug: bool = False,
-) -> ChatCompletion:
+    use_cache: bool = True,
+) -> AnalysisResult | str:
     """Main function to analyze a git diff using an OpenAI LLM."""
-    if not api_key:
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("OPENAI_API_KEY not found in environment variables or provided via --api-key argument")
-    try:
-        client = OpenAI(api_key=api_key)
-    except Exception as e:
-        raise ConnectionError(f"Failed to initialize OpenAI client: {e}")
-
+    api_key = resolve_api_key(api_key)
 
     print("Collecting diff context...")
-    analysis = collect_diff_context()
+    # Run the git subprocesses in a worker thread while the client is set up
+    context_task = asyncio.create_task(asyncio.to_thread(collect_diff_context, use_cache))
+    try:
+        client = make_client(api_key)
+    except ConnectionError:
+        context_task.cancel()
+        raise
+
+    analysis = await context_task
     if not analysis.diff_content:
         return "No changes detected by git diff."
 
     print("Creating LLM prompt...")
-    prompt = create_llm_prompt(analysis, debug)
+    groups = [analysis] if debug else partition_diff_analysis(analysis, model_name)
+    prompts = [create_llm_prompt(group, debug) for group in groups]
     print(f"Sending request to OpenAI model: {model_name}...")
     try:
-        completion = client.chat.completions.create(
-            model=model_name,
-            max_tokens=4096, # Keep max_tokens, adjust if needed for OpenAI models
-            messages=[{
-                "role": "user",
-                "content": prompt
-            }]
-        )
-        return completion
+        if len(prompts) == 1:
+            # Print tokens as they arrive
+            print("\n=== AI Analysis ===")
+            return await send(client, model_name, prompts[0], max_tokens=4096, echo=True)
+
+        # Large diffs are analyzed in parallel parts, printed once all of them are done
+        print(f"Diff split into {len(prompts)} parts to fit the prompt budget.")
+        result = merge_results(await send_many(client, model_name, prompts, max_tokens=4096))
+        print("\n=== AI Analysis ===")
+        print(result.content)
+        return result
 
     except Exception as e:
         # Catch potential API errors
         return f"Error calling OpenAI API: {e}"
 
-def calculate_cost(usage: CompletionUsage, model_name: str) -> float:
-    """Calculates the cost of usage in Dollar based on token counts."""
-    pricing = MODEL_PRICING.get(model_name, MODEL_PRICING["gpt-4o"])
-    prompt_cost = (usage.prompt_tokens / 1_000_000) * pricing["prompt"]
-    completion_cost = (usage.completion_tokens / 1_000_000) * pricing["completion"]
-    total_cost = prompt_cost + completion_cost
-    # Round the final result to 4 decimal places before returning
-    return round(total_cost, 6)
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Analyze git diffs using an OpenAI LLM")
     parser.add_argument(
@@ -199,21 +451,27 @@ if __name__ == "__main__":
         "--debug",
         help="Use hardcoded prompt for debugging",
     )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always read file contents from git instead of the on-disk cache"
+    )
 
     args = parser.parse_args()
 
     try:
-        result = analyze_diff(api_key=args.api_key, model_name=args.model, debug=args.debug)
-        analysis = result.choices[0].message.content
-        usage = result.usage
-        cost_of_usage = calculate_cost(usage, model_name=args.model)
-        print("\n=== AI Analysis ===")
-        print(analysis)
-        print("\n=== Cost of Usage ===")
-        print(f"  Prompt Tokens: {usage.prompt_tokens}")
-        print(f"  Completion Tokens: {usage.completion_tokens}")
-        print(f"  Cost in Dollar: {cost_of_usage}")
-    except (ValueError, ConnectionError, subprocess.CalledProcessError) as e:
+        result = asyncio.run(analyze_diff(api_key=args.api_key, model_name=args.model, debug=args.debug, use_cache=not args.no_cache))
+        if isinstance(result, str):
+            print(result)
+        elif result.usage:
+            usage = result.usage
+            cost_of_usage = calculate_cost(usage, model_name=args.model)
+            print("\n=== Cost of Usage ===")
+            print(f"  Prompt Tokens: {usage.prompt_tokens}")
+            print(f"  Cached Prompt Tokens: {cached_prompt_tokens(usage)}")
+            print(f"  Completion Tokens: {usage.completion_tokens}")
+            print(f"  Cost in Dollar: {cost_of_usage}")
+    except (ValueError, ConnectionError, RuntimeError, subprocess.CalledProcessError) as e:
         print(f"\nAn error occurred: {e}")
     except Exception as e:
         print(f"\nAn unexpected error occurred: {e}")
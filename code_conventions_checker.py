@@ -1,245 +1,23 @@
 #! /usr/bin/env python3
 import subprocess
 import os
-from typing import Dict, List
-from openai import OpenAI
-from openai.types import CompletionUsage
-from openai.types.chat import ChatCompletion
-from dataclasses import dataclass
 import argparse
+import asyncio
+import functools
+import itertools
+import re
+from typing import Awaitable, Iterable, Iterator
 from dotenv import load_dotenv
-from model_pricing import MODEL_PRICING
-
-load_dotenv()
-
-#! /usr/bin/env python3
-import subprocess
-import os
-import argparse
-from openai import OpenAI
-from dotenv import load_dotenv
+import _cache
+from _engine import (
+    AUTO_MODEL, cached_prompt_tokens, count_tokens, decode_output, embed, get_diff, iter_diff_files, make_client,
+    log_usage, pick_model, run_git, send, submit_batch,
+)
 
 # --- Constants ---
 
-KRAKEN_CODE_CONVENTIONS = (
-    "=== COMPANY CODE CONVENTIONS ===\n"
-    "\n"
-    "## Typing\n"
-    "\n"
-    "**Core Principle: All Python code MUST use static typing for enhanced clarity, correctness, and maintainability.**\n"
-    "\n"
-    "**Function and Method Signatures:**\n"
-    "1.  **Mandatory Explicit Annotations:** ALL parameters and the return type of EVERY function and method (including instance methods, class methods, and static methods) MUST have explicit type annotations.\n"
-    "    - This applies even if the function has no parameters or does not return a value.\n"
-    "    - **Good:** `def process_item(item: dict, quantity: int) -> bool:`\n"
-    "    - **Good:** `def get_configuration() -> ConfigType:`\n"
-    "    - **Bad (missing parameter type):** `def process_item(item, quantity: int) -> bool:`\n"
-    "    - **Bad (missing return type):** `def process_item(item: dict, quantity: int):`\n"
-    "    - **Bad (missing all types):** `def some_function(data):`\n"
-    "\n"
-    "2.  **Return Type for Procedures (`-> None`):** Functions or methods that do not explicitly return a value (i.e., procedures) MUST be annotated with `-> None`.\n"
-    "    - **Good:** `def log_event(event_name: str, details: dict) -> None:`\n"
-    "    - **Good (no parameters):** `def refresh_ui() -> None:`\n"
-    "    - **Bad:** `def log_event(event_name: str, details: dict):`\n"
-    "    - **Bad (no parameters):** `def refresh_ui():`\n"
-    "\n"
-    "3.  **`*args` and `**kwargs`:** Avoid `*args` and `**kwargs` where specific named parameters are more appropriate. If their use is unavoidable:\n"
-    "    - They MUST be typed (e.g., `*args: str`, `**kwargs: Any`).\n"
-    "    - Their intended structure and the types of arguments they represent should be clearly documented in the function's docstring.\n"
-    "    - Consider using `typing.Unpack` with `typing.TypedDict` for more precise `**kwargs` typing where applicable (Python 3.11+).\n"
-    "\n"
-    "4.  **Generic `**kwargs` for Specific Parameters:** Avoid using a generic `**kwargs` in a function signature if the function actually expects a fixed set of keyword arguments. Define these as explicit named parameters with types instead.\n"
-    "    - **Bad:** `def create_user(**kwargs): ...` (when `kwargs` is intended to be `{'name': str, 'email': str}`)\n"
-    "    - **Good:** `def create_user(name: str, email: str, is_active: bool = True) -> User:`\n"
-    "\n"
-    "5.  **Use of `typing.Any`:** Use `typing.Any` sparingly. Prefer more specific types (e.g., `str`, `int`, `object`, `Union[str, int]`, custom classes, `TypedDict`, generics like `List[str]`) whenever possible. If `Any` is used, it should ideally be justified with a comment if the reason is not obvious.\n"
-    "\n"
-    "6.  **Highly Parameterized Functions:** For functions or methods with a large number of parameters (e.g., more than 5 or 6), consider grouping related parameters into a single data class (`@dataclass` or `attrs`) or a `TypedDict` to improve readability and maintainability.\n"
-    "    - Example: `class UserCreationParams(TypedDict): name: str; email: str; age: int | None`\n"
-    "               `def create_user(params: UserCreationParams) -> User:`\n"
-    "\n"
-    # ... (other typing rules you might have, like for variable annotations if desired) ...
-    "\n"
-    "---\n"
-    "## Imports\n"
-    "\n"
-    "Use absolute imports for public modules.\n"
-    "\n"
-    "Use relative imports for private modules (modules with a leading underscore).\n"
-    "\n"
-    "In tests, absolute imports of private modules are allowed.\n"
-    "\n"
-    "Import modules, not objects.\n"
-    "- Prefer: from django import http\n"
-    "- Avoid: from django.http import HttpResponse\n"
-    "\n"
-    "Direct object imports are allowed for standard/common built-ins.\n"
-    "- Examples: from decimal import Decimal, from typing import Optional\n"
-    "\n"
-    "Avoid wildcard imports (from module import *).\n"
-    "\n"
-    "Do not expose modules as public objects in __init__.py.\n"
-    "\n"
-    "---\n"
-    "\n"
-    "## Naming\n"
-    "\n"
-    "Use singular nouns for class names.\n"
-    "- Bad: class UserProfiles\n"
-    "- Good: class UserProfile\n"
-    "\n"
-    "Name private things with a leading underscore.\n"
-    "- Applies to classes, methods, functions, modules, and variables.\n"
-    "\n"
-    "Use a trailing underscore to avoid name collisions with built-ins.\n"
-    "- Example: property_ = ...\n"
-    "\n"
-    "Avoid suffixing kwargs with underscore. Instead, rename meaningfully.\n"
-    "- Prefer: def to_string(input_date: date | None)\n"
-    "- Avoid: def to_string(date_: date | None)\n"
-    "\n"
-    "---\n"
-    "\n"
-    "## Convenience Imports\n"
-    "\n"
-    "Use __init__.py to expose public objects only.\n"
-    "\n"
-    "Use underscores for private module names to enforce import consistency.\n"
-    "- mypackage/__init__.py\n"
-    "- mypackage/_foo.py\n"
-    "\n"
-    "Avoid convenience imports in packages with public children.\n"
-    "- Prevents unnecessary bootstrapping and circular dependencies.\n"
-    "\n"
-    "---\n"
-    "\n"
-    "## Exceptions\n"
-    "\n"
-    "Raise distinct exception types for different failure modes.\n"
-    "- Avoid reusing a single error class for multiple conditions.\n"
-    "\n"
-    "Do not include end-user messages in exception messages.\n"
-    "- User-facing messages belong in the caller.\n"
-    "\n"
-    "Include relevant details as attributes on exception classes.\n"
-    "\n"
-    "Catch specific exception types. Avoid bare except.\n"
-    "\n"
-    "Only catch Exception if:\n"
-    "- You are re-raising after logging.\n"
-    "- You want to present a user-friendly error in views.\n"
-    "\n"
-    "Avoid catching BaseException.\n"
-    "\n"
-    "Prefer raising exceptions over assert for runtime checks.\n"
-    "\n"
-    "Assertions are for:\n"
-    "- Type narrowing\n"
-    "- Development-time debugging\n"
-    "- Validating internal invariants\n"
-    "\n"
-    "Do not validate external input with assert. Use serializers.\n"
-    "\n"
-    "---\n"
-    "\n"
-    "## Return Behavior\n"
-    "\n"
-    "Avoid silent returns on precondition failures.\n"
-    "- Bad: if not_ready(): return\n"
-    "- Good: if not_ready(): raise NotReady()\n"
-    "\n"
-    "Use wrapper functions to explicitly handle \"fire-and-forget\" flows.\n"
-    "- Swallow only specific exceptions in those wrappers.\n"
-    "\n"
-    "---\n"
-    "\n"
-    "## Linting and Static Analysis\n"
-    "\n"
-    "Never silence all errors with blanket ignores.\n"
-    "\n"
-    "Always specify the rule or error being silenced.\n"
-    "- Good: # noqa: F401\n"
-    "- Good: # type: ignore[attr-defined]\n"
-    "\n"
-    "Justify all silencing comments.\n"
-    "- Include rationale or link to relevant bug report.\n"
-    "\n"
-    "---\n"
-    "\n"
-    "## Docstrings\n"
-    "\n"
-    "Start with an imperative description.\n"
-    "- Format: \"This function will ...\"\n"
-    "\n"
-    "Use newline after opening and before closing triple quotes.\n"
-    "- End first sentence with a period.\n"
-    "\n"
-    "Use type annotations for parameters and return types.\n"
-    "\n"
-    "Document raised exceptions using `:raises ExceptionType:` format.\n"
-    "\n"
-    "Use comments (# ...) for implementation detail explanations.\n"
-    "Use docstrings (\"\"\" ... \"\"\") for user-facing documentation.\n"
-    "\n"
-    "---\n"
-    "\n"
-    "## Spelling\n"
-    "\n"
-    "Prefer American English.\n"
-    "- Example: use \"serializers\" not \"serialisers\"\n"
-    "\n"
-    "---\n"
-    "\n"
-    "## HTTP Requests\n"
-    "\n"
-    "Use `requests` library with explicit timeouts.\n"
-    "- Example: requests.get(\"url\", timeout=10)\n"
-    "\n"
-    "Consider using HTTPClient or JSONClient wrappers.\n"
-    "\n"
-    "Do not make network requests without a timeout.\n"
-    "\n"
-    "---\n"
-    "\n"
-    "## Immutability\n"
-    "\n"
-    "Use immutable types when possible.\n"
-    "- Use @attrs.frozen instead of @attrs.define\n"
-    "- Use frozenset instead of set\n"
-    "- Use tuple or Sequence instead of list\n"
-    "\n"
-    "Avoid mixing immutable containers with mutable internals.\n"
-    "\n"
-    "---\n"
-    "\n"
-    "## attrs vs dataclasses\n"
-    "\n"
-    "Prefer attrs over dataclasses.\n"
-    "- attrs has more features\n"
-    "- Calls super() in __init__\n"
-    "- Uses less memory (slots)\n"
-    "- Faster iteration (not tied to Python release schedule)\n"
-    "\n"
-    "Use new attrs API (`attrs.define`, `attrs.frozen`)\n"
-    "- Avoid old `import attr` and `@attr.s` syntax\n"
-    "\n"
-    "---\n"
-    "\n"
-    "## Import-Time Side Effects\n"
-    "\n"
-    "Do not have import-time side effects.\n"
-    "- No registry population\n"
-    "- No logging\n"
-    "- No URL lookups\n"
-    "\n"
-    "Register dynamic contents in application startup hooks (e.g. Django’s ready method).\n"
-    "\n"
-    "Use reverse_lazy instead of reverse for constants or default args.\n"
-    "\n"
-    "Side effects must be intentional and explicit.\n"
-    "\n"
-    "=== END COMPANY CODE CONVENTIONS ==="
-)
+# Company conventions the diff is checked against, kept next to this script
+CONVENTIONS_FILENAME = "kraken_code_conventions.md"
 
 LLM_INSTRUCTION = (
     "You are an AI code reviewer focused *only* on compliance.\n"
@@ -263,24 +41,40 @@ LLM_INSTRUCTION = (
     "- Do NOT report issues in lines that were present before and are unchanged, even if they violate conventions.\n"
 )
 
+NO_VIOLATIONS_MESSAGE = "No convention violations found."
+MAX_COMPLETION_TOKENS = 2000
+REPORT_HEADER = "\n=== AI Code Convention Analysis ==="
+
+CONVENTIONS_HEADER = "=== COMPANY CODE CONVENTIONS ===\n"
+CONVENTIONS_FOOTER = "=== END COMPANY CODE CONVENTIONS ==="
+CONVENTIONS_SECTION_SEPARATOR = "---\n"
+DIFF_MARKER = "**GIT DIFF:**\n"
+
+# Convention sections sent only when one of their keywords occurs in the diff, to save input tokens.
+# Sections not listed here (Typing, Naming, Spelling) apply to nearly any change and are always sent.
+SECTION_KEYWORDS = {
+    "Imports": ("import ", "from "),
+    "Convenience Imports": ("__init__", "import "),
+    "Exceptions": ("raise ", "except", "Error", "Exception", "assert "),
+    "Return Behavior": ("return",),
+    "Linting and Static Analysis": ("noqa", "type: ignore", "pylint", "mypy"),
+    "Docstrings": ('"""', "'''"),
+    "HTTP Requests": ("requests", "http", "urllib", "timeout"),
+    "Immutability": ("set(", "list", "List", "dict", "Dict", "tuple", "Sequence", "frozen", "attrs"),
+    "attrs vs dataclasses": ("dataclass", "attr"),
+    "Import-Time Side Effects": ("import ", "register", "logging", "logger", "reverse"),
+}
+
+SECTION_TITLE_RE = re.compile(r'^## (.+)$', re.MULTILINE)
+
 # --- Functions ---
 
 def get_merge_base_with_branch(base_branch: str = "main") -> str | None:
     """Finds the merge-base commit SHA between the current HEAD and a base branch."""
     try:
-        # Get the current branch's HEAD commit SHA
-        head_commit_process = subprocess.run(
-            ["git", "rev-parse", "HEAD"],
-            capture_output=True, text=True, check=True
-        )
-        head_commit = head_commit_process.stdout.strip()
-
-        # Get the merge base SHA
-        merge_base_process = subprocess.run(
-            ["git", "merge-base", base_branch, head_commit],
-            capture_output=True, text=True, check=True
-        )
-        merge_base_sha = merge_base_process.stdout.strip()
+        # git resolves HEAD itself, so no separate rev-parse is needed
+        merge_base_process = run_git(["merge-base", base_branch, "HEAD"])
+        merge_base_sha = decode_output(merge_base_process.stdout).strip()
 
         if not merge_base_sha: # Should be caught by check=True if command is valid
             print(f"Warning: Could not determine merge-base between '{base_branch}' and HEAD.")
@@ -288,7 +82,7 @@ def get_merge_base_with_branch(base_branch: str = "main") -> str | None:
         return merge_base_sha
     except subprocess.CalledProcessError as e:
         # This can happen if base_branch doesn't exist or there's no common ancestor
-        error_output = e.stderr.strip() if e.stderr else str(e)
+        error_output = decode_output(e.stderr).strip() if e.stderr else str(e)
         print(f"Warning: Failed to get merge-base with '{base_branch}'. "
               f"Is '{base_branch}' a valid branch and reachable? Error: {error_output}")
         return None
@@ -302,61 +96,174 @@ def get_git_diff_against_head() -> str:
     Get the git diff for all uncommitted changes against HEAD.
     Includes a workaround for git diff potentially returning exit code 0 even with output.
     """
-    try:
-        command = ["git", "diff", "--no-ext-diff", "HEAD"]
+    return get_diff(against_head=True)
 
-        process = subprocess.run(
-            command,
-            capture_output=True,
-            text=True,
-            check=False  # Manually check return codes
-        )
+def iter_git_diff_against_head() -> Iterator[str]:
+    """Streams the git diff against HEAD one file section at a time, as git produces it."""
+    return iter_diff_files(against_head=True)
 
-        if process.returncode > 1:
-            cmd_str = ' '.join(command) # For error message
-            error_message = f"Error running '{cmd_str}' (return code {process.returncode}):"
-            if process.stderr:
-                error_message += f"\nGit stderr: {process.stderr.strip()}"
-            print(error_message) # Keep this error reporting
-            raise RuntimeError(f"Git command '{cmd_str}' failed with code {process.returncode}")
-
-        # If exit code is 0 or 1, rely on stdout content.
-        # If stdout has content, we consider it a diff.
-        # If stdout is empty (or only whitespace), then no diff.
-        if process.stdout and process.stdout.strip():
-            return process.stdout
-        else:
-            return ""
+@functools.lru_cache(maxsize=None)
+def load_conventions() -> str:
+    """Reads the company conventions on first use, so runs that never build a prompt (e.g. --help) skip it."""
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), CONVENTIONS_FILENAME), 'r', encoding='utf-8') as f:
+        return f.read().rstrip("\n")
 
-    except FileNotFoundError:
-        print("Error: 'git' command not found. Ensure git is installed and in your PATH.") # Keep this error reporting
-        raise
+@functools.lru_cache(maxsize=None)
+def _convention_sections() -> dict[str, str]:
+    """Splits the conventions into their sections, keyed by section title, in document order."""
+    body = load_conventions().removeprefix(CONVENTIONS_HEADER).removesuffix(CONVENTIONS_FOOTER)
+    return {
+        SECTION_TITLE_RE.search(section).group(1): section
+        for section in body.split(CONVENTIONS_SECTION_SEPARATOR)
+    }
 
-def create_llm_prompt(diff_content: str) -> str:
-    """Creates the LLM prompt including conventions, instructions, and the diff."""
-    return (
-        f"{KRAKEN_CODE_CONVENTIONS}\n\n"
-        f"{LLM_INSTRUCTION}\n\n"
-        f"**GIT DIFF:**\n{diff_content}"
+def select_convention_sections(diff_content: str) -> tuple[str, ...]:
+    """Returns the titles of the convention sections relevant to the diff, always-sent sections first."""
+    relevant = [
+        title for title in _convention_sections()
+        if title not in SECTION_KEYWORDS or any(keyword in diff_content for keyword in SECTION_KEYWORDS[title])
+    ]
+    # Stable sort: document order is kept within the always-sent and the conditional sections
+    return tuple(sorted(relevant, key=lambda title: title in SECTION_KEYWORDS))
+
+@functools.lru_cache(maxsize=None)
+def _prompt_prefix(section_titles: tuple[str, ...]) -> str:
+    """Joins the static part of the prompt for the given convention sections."""
+    # OpenAI's automatic prompt caching applies to a byte-identical prompt start of at least 1024 tokens.
+    # The instruction and the always-sent sections come first, so every prompt shares that start
+    # whichever conditional sections follow it.
+    sections = _convention_sections()
+    conventions = (
+        CONVENTIONS_HEADER
+        + CONVENTIONS_SECTION_SEPARATOR.join(sections[title] for title in section_titles)
+        + CONVENTIONS_FOOTER
     )
+    return f"{LLM_INSTRUCTION}\n\n{conventions}\n\n{DIFF_MARKER}"
+
+def create_llm_prompt(diff_content: str) -> str:
+    """Creates the LLM prompt including the conventions relevant to the diff, instructions, and the diff."""
+    return _prompt_prefix(select_convention_sections(diff_content)) + diff_content
+
+def estimate_prompt_tokens(prompt: str, model_name: str) -> int:
+    """Estimates the prompt's tokens, tokenizing each static prefix only once per model (count_tokens caches it)."""
+    prefix, marker, diff_content = prompt.partition(DIFF_MARKER)
+    if not marker:
+        return count_tokens(prompt, model_name)
+    # Counting the parts separately may differ by a token at the seam, which is fine for an estimate
+    return count_tokens(prefix + marker, model_name) + count_tokens(diff_content, model_name)
+
+async def analyze_with_llm(
+    api_key: str,
+    model_name: str,
+    prompt: str,
+    use_cache: bool = True,
+    semantic_cache: bool = False,
+    echo: bool = False,
+) -> str:
+    """
+    Sends the prompt to the OpenAI LLM and returns the analysis, reusing the cached answer for an identical prompt.
+    With echo, the analysis is also printed, token by token as it streams in.
+    """
+    if model_name == AUTO_MODEL:
+        model_name = pick_model(prompt, MAX_COMPLETION_TOKENS, estimate_prompt_tokens(prompt, "gpt-4o"))
+    # The low temperature makes answers to the same prompt close to deterministic, so they are worth caching
+    key = _cache.cache_key(model_name, prompt)
+    if use_cache and (cached := _cache.get_response(key)) is not None:
+        log_usage(model_name, None, source="response_cache")
+        if echo:
+            print(cached)
+        return cached
+
+    client = make_client(api_key)
+    embedding = None
+    if use_cache and semantic_cache:
+        # Only the diff is embedded, the static prefix would dominate the similarity
+        try:
+            embedding = await embed(client, _cache.normalize_diff(prompt.partition(DIFF_MARKER)[2]))
+        except Exception as e:
+            print(f"Warning: Could not embed diff for the semantic cache: {e}")
+        if embedding is not None and (similar := _cache.find_similar_response(model_name, embedding)) is not None:
+            log_usage(model_name, None, source="semantic_cache")
+            if echo:
+                print(similar)
+            return similar
 
-def analyze_with_llm(api_key: str, model_name: str, prompt: str):
-    """Sends the prompt to the OpenAI LLM and returns the analysis."""
-    client = OpenAI(api_key=api_key)
     try:
-        completion = client.chat.completions.create(
-            model=model_name,
-            messages=[{
-                "role": "user",
-                "content": prompt
-            }],
-            temperature = 0.1,  # Set a low temperature for more factual and precise output
-            max_tokens=2000
+        # Set a low temperature for more factual and precise output
+        result = await send(
+            client, model_name, prompt, max_tokens=MAX_COMPLETION_TOKENS, temperature=0.1, echo=echo,
+            prompt_tokens=estimate_prompt_tokens(prompt, model_name)
         )
-        return completion.choices[0].message.content
     except Exception as e:
         print(f"Error calling OpenAI API: {e}")
         raise
+    if result.usage:
+        print(f"Info: {cached_prompt_tokens(result.usage)}/{result.usage.prompt_tokens} prompt tokens served from OpenAI's prompt cache.")
+    if use_cache:
+        _cache.set_response(key, result.content)
+        if embedding is not None:
+            _cache.add_similar_response(model_name, embedding, result.content)
+    return result.content
+
+async def analyze_diff_by_file(
+    api_key: str,
+    model_name: str,
+    file_diffs: Iterable[str],
+    use_cache: bool = True,
+    semantic_cache: bool = False,
+    echo: bool = False,
+) -> str:
+    """
+    Checks each file's diff in its own concurrent request and merges the reports in diff order.
+    Requests start as soon as their file is read, so a streamed diff overlaps git with the LLM calls.
+    With echo, the report is also printed; a single-file diff is streamed as its tokens arrive.
+    """
+    file_diffs = iter(file_diffs)
+
+    def analyze(file_diff: str, echo: bool = False) -> Awaitable[str]:
+        # Per-file prompts keep each request's input small instead of resending the whole diff
+        return analyze_with_llm(api_key, model_name, create_llm_prompt(file_diff), use_cache, semantic_cache, echo)
+
+    async def next_file_diff() -> str | None:
+        # The diff may be read from a pipe, so pulling it must not block the event loop
+        return await asyncio.to_thread(next, file_diffs, None)
+
+    print(f"Sending requests to OpenAI model: {model_name}...")
+    first, second = await next_file_diff(), await next_file_diff()
+    if first is None:
+        return NO_VIOLATIONS_MESSAGE
+    if second is None and echo:
+        print(REPORT_HEADER)
+        return merge_analyses([await analyze(first, echo=True)])
+
+    tasks = [asyncio.create_task(analyze(file_diff)) for file_diff in (first, second) if file_diff is not None]
+    while (file_diff := await next_file_diff()) is not None:
+        tasks.append(asyncio.create_task(analyze(file_diff)))
+    print(f"Waiting for {len(tasks)} request(s)...")
+
+    # Concurrent reports would interleave on stdout, so they are printed once merged
+    report = merge_analyses(list(await asyncio.gather(*tasks)))
+    if echo:
+        print(REPORT_HEADER)
+        print(report)
+    return report
+
+async def submit_diff_batch(api_key: str, model_name: str, file_diffs: Iterable[str]) -> str:
+    """Submits one convention check per file as a Batch API job and returns the batch ID."""
+    prompts = [create_llm_prompt(file_diff) for file_diff in file_diffs]
+    if model_name == AUTO_MODEL:
+        # A batch job uses one model, so it is picked for the largest prompt
+        largest_prompt = max(prompts, key=len)
+        model_name = pick_model(largest_prompt, MAX_COMPLETION_TOKENS, estimate_prompt_tokens(largest_prompt, "gpt-4o"))
+    print(f"Submitting {len(prompts)} request(s) as a batch for OpenAI model: {model_name}...")
+    return await submit_batch(
+        make_client(api_key), model_name, prompts, max_tokens=MAX_COMPLETION_TOKENS, temperature=0.1
+    )
+
+def merge_analyses(analyses: list[str]) -> str:
+    """Combines per-file analyses into one report, collapsing the files without violations."""
+    findings = [analysis for analysis in analyses if analysis.strip().strip("`") != NO_VIOLATIONS_MESSAGE]
+    return "\n\n".join(findings) if findings else NO_VIOLATIONS_MESSAGE
 
 # --- Main Execution ---
 
@@ -374,13 +281,30 @@ if __name__ == "__main__":
     parser.add_argument(
         "--model",
         default="gpt-4o", # Or another model like gpt-4-turbo
-        help="OpenAI model name to use."
+        help="OpenAI model name to use, or 'auto' for the cheapest priced model adequate for each prompt's size."
     )
     parser.add_argument(
         "--base-branch",
         default="master",
         help="The base branch to compare against for the default 'all changes' diff (e.g., main, develop). Default: main."
     )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always query the LLM instead of reusing cached answers for identical prompts."
+    )
+    parser.add_argument(
+        "--semantic-cache",
+        action="store_true",
+        help="Also reuse answers for near-identical diffs, matched by embedding similarity (one embedding request per diff)."
+    )
+    parser.add_argument(
+        "--mode",
+        choices=["realtime", "batch"],
+        default="realtime",
+        help="'batch' submits the checks through the OpenAI Batch API (half price, results within 24h) "
+             "and prints the batch ID instead of waiting for the analysis."
+    )
 
     args = parser.parse_args()
 
@@ -391,24 +315,33 @@ if __name__ == "__main__":
     print("Fetching uncommitted changes against HEAD...")
     try:
         merge_base_sha = get_merge_base_with_branch(args.base_branch)
-        diff_text = get_git_diff_against_head()
-        # print(f"Diff against head for {args.model}:\n{diff_text}")
+        file_diffs = iter_git_diff_against_head()
+        # Reading the first file surfaces git errors here; the rest is read while the requests run
+        first_file_diff = next(file_diffs, None)
     except (FileNotFoundError, subprocess.CalledProcessError, RuntimeError):
         print("Failed to get git diff. Exiting.")
         exit(1)
 
-    if not diff_text.strip():
+    if first_file_diff is None:
         print("No changes detected to analyze.")
         exit(0)
 
-    print("Creating prompt for LLM...")
-    prompt_payload = create_llm_prompt(diff_text)
+    if args.mode == "batch":
+        try:
+            batch_id = asyncio.run(submit_diff_batch(
+                args.api_key, args.model, itertools.chain([first_file_diff], file_diffs)
+            ))
+        except Exception as e:
+            print(f"Failed to submit batch: {e}")
+            exit(1)
+        print(f"Submitted batch {batch_id}. Each result's custom_id is the index of its file in the diff.")
+        exit(0)
 
-    print(f"Sending request to OpenAI model: {args.model}...")
     try:
-        analysis_result = analyze_with_llm(args.api_key, args.model, prompt_payload)
-        print("\n=== AI Code Convention Analysis ===")
-        print(analysis_result)
+        asyncio.run(analyze_diff_by_file(
+            args.api_key, args.model, itertools.chain([first_file_diff], file_diffs), use_cache=not args.no_cache,
+            semantic_cache=args.semantic_cache, echo=True
+        ))
     except Exception:
         print("Failed to get analysis from LLM. Exiting.")
         exit(1)
\ No newline at end of file
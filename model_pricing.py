@@ -1,23 +1,31 @@
+from typing import NamedTuple
+
+class Price(NamedTuple):
+    prompt: float
+    completion: float
+
 # Prices are per 1,000,000 tokens in USD (as of late April 2025)
 MODEL_PRICING = {
-    "gpt-4.1": {
-        "prompt": 2.00,
-        "completion": 8.00
-    },
-    "gpt-4.1-mini": {
-        "prompt": 0.40,
-        "completion": 1.60
-    },
-    "gpt-4.1-nano": {
-        "prompt": 0.10,
-        "completion": 0.40
-    },
-    "gpt-4o": {
-        "prompt": 2.50,
-        "completion": 10.00
-    },
-    "gpt-4o-mini": {
-        "prompt": 0.15,
-        "completion": 0.60
-    }
-}
\ No newline at end of file
+    "gpt-4.1": Price(prompt=2.00, completion=8.00),
+    "gpt-4.1-mini": Price(prompt=0.40, completion=1.60),
+    "gpt-4.1-nano": Price(prompt=0.10, completion=0.40),
+    "gpt-4o": Price(prompt=2.50, completion=10.00),
+    "gpt-4o-mini": Price(prompt=0.15, completion=0.60)
+}
+
+# Context window sizes in tokens (prompt + completion)
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4.1": 1_047_576,
+    "gpt-4.1-mini": 1_047_576,
+    "gpt-4.1-nano": 1_047_576,
+    "gpt-4o": 128_000,
+    "gpt-4o-mini": 128_000
+}
+
+# Largest prompt (in tokens) a model is trusted with when picked automatically, where that is below its
+# context window. The cheapest models are only adequate for small diffs: nano for ~200 changed lines plus
+# the conventions, gpt-4o-mini for medium-sized ones
+MODEL_MAX_PROMPT_TOKENS = {
+    "gpt-4.1-nano": 5_000,
+    "gpt-4o-mini": 32_000
+}
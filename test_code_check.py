@@ -0,0 +1,142 @@
+import subprocess
+import unittest
+from contextlib import redirect_stdout
+from io import StringIO
+from unittest import mock
+import code_check
+from code_check import (
+    HUNK_CONTEXT_LINES,
+    _read_files_batch,
+    diff_section_path,
+    extract_hunk_windows,
+    get_changed_files,
+    parse_diff_hunks,
+)
+
+MODIFIED_PATH_WITH_B_DIFF = (
+    "diff --git a/x b/y.py b/x b/y.py\n"
+    "index 7898192..422c2b7 100644\n"
+    "--- a/x b/y.py\t\n"
+    "+++ b/x b/y.py\t\n"
+    "@@ -1 +1,2 @@\n"
+    " a\n"
+    "+b\n"
+)
+
+RENAME_DIFF = (
+    "diff --git a/p b/q.py b/p b/r b.py\n"
+    "similarity index 75%\n"
+    "rename from p b/q.py\n"
+    "rename to p b/r b.py\n"
+    "index 9405325..a3a5d5e 100644\n"
+    "--- a/p b/q.py\t\n"
+    "+++ b/p b/r b.py\t\n"
+    "@@ -1,3 +1,4 @@\n"
+    " l1\n"
+    " l2\n"
+    " l3\n"
+    "+l4\n"
+)
+
+QUOTED_RENAME_DIFF = (
+    'diff --git "a/a\\\\b.txt" "b/q\\"\\tb/\\303\\251.txt"\n'
+    "similarity index 75%\n"
+    'rename from "a\\\\b.txt"\n'
+    'rename to "q\\"\\tb/\\303\\251.txt"\n'
+    "index 01e79c3..94ebaf9 100644\n"
+    '--- "a/a\\\\b.txt"\n'
+    '+++ "b/q\\"\\tb/\\303\\251.txt"\n'
+    "@@ -1,3 +1,4 @@\n"
+    " 1\n"
+    " 2\n"
+    " 3\n"
+    "+4\n"
+)
+
+# `git cat-file --batch` output for a blob, a missing path with spaces, a tree (binary content) and another blob
+CAT_FILE_BATCH_OUTPUT = (
+    b"78981922613b2afb6025042ff6bd878ac1994e85 blob 2\na\n\n"
+    b"HEAD:no such file.py missing\n"
+    b"e866593fcfc605efb803866a976e29da4a2043da tree 32\n"
+    b"100644 q.py\x00\xf0\xf20td)\x19\xbbP\xab[nN\xc4\x89pa'\xf0a\n"
+    b"b68025345d5301abad4d9ec9166f455243a0d746 blob 2\nz\n\n"
+)
+
+class TestDiffHeaderParsing(unittest.TestCase):
+    def test_path_containing_b_slash(self):
+        self.assertEqual(diff_section_path(MODIFIED_PATH_WITH_B_DIFF), "x b/y.py")
+
+    def test_rename_uses_new_path(self):
+        self.assertEqual(diff_section_path(RENAME_DIFF), "p b/r b.py")
+
+    def test_rename_without_hunks(self):
+        diff = (
+            "diff --git a/old b/x b/new b/x\n"
+            "similarity index 100%\n"
+            "rename from old b/x\n"
+            "rename to new b/x\n"
+        )
+        self.assertEqual(diff_section_path(diff), "new b/x")
+
+    def test_quoted_paths(self):
+        cases = [
+            ('diff --git "a/t\\tb" "b/t\\tb"\n', "t\tb"),
+            ('diff --git "a/back\\\\slash" "b/back\\\\slash"\n', "back\\slash"),
+            ('diff --git "a/say \\"hi\\"" "b/say \\"hi\\""\n', 'say "hi"'),
+            ('diff --git "a/\\303\\251 b.py" "b/\\303\\251 b.py"\n', "\u00e9 b.py"),
+            ('diff --git "a/x b/\\tz" "b/x b/\\tz"\n', "x b/\tz"),
+        ]
+        for diff, expected in cases:
+            with self.subTest(diff=diff):
+                self.assertEqual(diff_section_path(diff), expected)
+
+    def test_quoted_rename(self):
+        self.assertEqual(diff_section_path(QUOTED_RENAME_DIFF), 'q"\tb/\u00e9.txt')
+
+    def test_quoted_path_with_tab_suffixed_new_path_line(self):
+        # Ambiguous renames fall back to the `+++` line, which git suffixes with a tab for paths with spaces
+        diff = (
+            'diff --git a/a b/c b/d b/e\n'
+            '--- "a/a b/c"\t\n'
+            '+++ "b/d b/\\303\\251"\t\n'
+        )
+        self.assertEqual(diff_section_path(diff), "d b/\u00e9")
+
+    def test_changed_files_and_hunks(self):
+        diff = RENAME_DIFF + MODIFIED_PATH_WITH_B_DIFF
+        self.assertEqual(get_changed_files(diff), ["p b/r b.py", "x b/y.py"])
+        self.assertEqual(parse_diff_hunks(diff), {"p b/r b.py": [(1, 3)], "x b/y.py": [(1, 1)]})
+
+class TestReadFilesBatch(unittest.TestCase):
+    def test_mixed_batch_output(self):
+        paths = ["x b/y.py", "no such file.py", "p b", "\u00e9 b.py"]
+        completed = subprocess.CompletedProcess([], 0, stdout=CAT_FILE_BATCH_OUTPUT)
+        with mock.patch.object(code_check, "run_git", return_value=completed) as run_git, redirect_stdout(StringIO()):
+            contents = _read_files_batch(paths, "HEAD")
+        self.assertEqual(contents, {"x b/y.py": "a\n", "no such file.py": "", "p b": "", "\u00e9 b.py": "z\n"})
+        self.assertEqual(
+            run_git.call_args.kwargs["input_data"],
+            "HEAD:x b/y.py\nHEAD:no such file.py\nHEAD:p b\nHEAD:\u00e9 b.py\n".encode("utf-8"),
+        )
+
+class TestExtractHunkWindows(unittest.TestCase):
+    def test_merges_overlapping_windows_and_marks_omitted_ranges(self):
+        lines = [f"line {number}\n" for number in range(1, 601)]
+        # The first two hunks' windows overlap and merge; the third stands alone
+        hunks = [(400, 1), (100, 5), (150, 10)]
+        self.assertEqual(HUNK_CONTEXT_LINES, 50)
+        expected = (
+            "... [lines 1-49 omitted] ...\n"
+            + "".join(lines[49:210])
+            + "... [lines 211-349 omitted] ...\n"
+            + "".join(lines[349:451])
+            + "... [lines 452-600 omitted] ...\n"
+        )
+        self.assertEqual(extract_hunk_windows("".join(lines), hunks), expected)
+
+    def test_short_file_is_kept_whole(self):
+        content = "".join(f"line {number}\n" for number in range(1, 11))
+        self.assertEqual(extract_hunk_windows(content, [(5, 1)]), content)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import types
+import unittest
+from contextlib import redirect_stdout
+from io import StringIO
+from unittest import mock
+import _engine
+from _engine import RATE_LIMIT_WINDOW, RateLimiter
+
+class FakeClock:
+    """Stands in for time.monotonic and asyncio.sleep, advancing instantly instead of waiting."""
+
+    def __init__(self) -> None:
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    async def sleep(self, delay: float) -> None:
+        self.sleeps.append(delay)
+        self.now += delay
+
+class TestRateLimiter(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patchers = [
+            # Replaces only _engine's view of the time module, the event loop keeps the real clock
+            mock.patch.object(_engine, "time", types.SimpleNamespace(monotonic=self.clock.monotonic)),
+            mock.patch.object(_engine.asyncio, "sleep", self.clock.sleep),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_requests_within_budget_do_not_wait(self):
+        limiter = RateLimiter(max_concurrent=4, tokens_per_minute=100)
+        for _ in range(2):
+            async with limiter.reserve(50):
+                pass
+        self.assertEqual(self.clock.sleeps, [])
+
+    async def test_request_over_budget_waits_for_window(self):
+        limiter = RateLimiter(max_concurrent=4, tokens_per_minute=100)
+        async with limiter.reserve(80):
+            pass
+        self.clock.now = 10.0
+        async with limiter.reserve(30) as reservation:
+            pass
+        # Waits until the first reservation leaves the window
+        self.assertEqual(self.clock.sleeps, [RATE_LIMIT_WINDOW - 10.0])
+        self.assertEqual(reservation.timestamp, RATE_LIMIT_WINDOW)
+
+    async def test_oversized_request_is_let_through_alone(self):
+        limiter = RateLimiter(max_concurrent=4, tokens_per_minute=100)
+        async with limiter.reserve(500):
+            pass
+        self.assertEqual(self.clock.sleeps, [])
+        async with limiter.reserve(1):
+            pass
+        self.assertEqual(self.clock.sleeps, [RATE_LIMIT_WINDOW])
+
+    async def test_actual_usage_replaces_estimate(self):
+        limiter = RateLimiter(max_concurrent=4, tokens_per_minute=100)
+        async with limiter.reserve(90) as reservation:
+            reservation.tokens = 20
+        async with limiter.reserve(80):
+            pass
+        self.assertEqual(self.clock.sleeps, [])
+
+class TestRateLimiterEventLoops(unittest.TestCase):
+    def test_limiter_works_across_event_loops(self):
+        async def contend():
+            limiter = _engine.get_rate_limiter()
+            async def hold():
+                async with limiter.reserve(1):
+                    await asyncio.sleep(0)
+            await asyncio.gather(*(hold() for _ in range(3)))
+            return limiter
+
+        with mock.patch.dict(_engine.os.environ, {"OAI_CONCURRENCY": "1"}):
+            first = asyncio.run(contend())
+            second = asyncio.run(contend())
+        self.assertIsNot(first, second)
+
+class TestCountTokens(unittest.TestCase):
+    def setUp(self):
+        for cached in (_engine._get_encoding, _engine.count_tokens):
+            cached.cache_clear()
+            self.addCleanup(cached.cache_clear)
+
+    def test_falls_back_to_estimate_when_encoding_cannot_load(self):
+        # tiktoken downloads its BPE files on first use, which fails offline
+        fake_tiktoken = mock.Mock()
+        fake_tiktoken.encoding_for_model.side_effect = ConnectionError("offline")
+        with mock.patch.object(_engine, "tiktoken", fake_tiktoken), redirect_stdout(StringIO()):
+            self.assertEqual(_engine.count_tokens("x" * 40, "gpt-4o"), 40 // _engine.CHARS_PER_TOKEN)
+            self.assertEqual(_engine.count_tokens("y" * 80, "gpt-4o"), 80 // _engine.CHARS_PER_TOKEN)
+        self.assertEqual(fake_tiktoken.encoding_for_model.call_count, 1)
+
+class TestPickModel(unittest.TestCase):
+    def test_prompt_size_routes_to_different_models(self):
+        cases = [
+            (1_000, "gpt-4.1-nano"),
+            (20_000, "gpt-4o-mini"),
+            (500_000, "gpt-4.1-mini"),
+        ]
+        for prompt_tokens, expected in cases:
+            with self.subTest(prompt_tokens=prompt_tokens):
+                self.assertEqual(_engine.pick_model("", max_tokens=2000, prompt_tokens=prompt_tokens), expected)
+
+    def test_prompt_beyond_every_context_window(self):
+        with self.assertRaises(ValueError):
+            _engine.pick_model("", max_tokens=2000, prompt_tokens=2_000_000)
+
+# Writes far more than a pipe buffer of warnings to stderr before any diff output, then exits 1 like git diff
+FAKE_GIT_SCRIPT = (
+    "import sys\n"
+    "sys.stderr.write('warning: LF will be replaced by CRLF\\n' * 30000)\n"
+    "sys.stdout.write('diff --git a/x b/x\\n+1\\ndiff --git a/y b/y\\n+2\\n')\n"
+    "sys.exit(1)\n"
+)
+
+class TestIterDiffFiles(unittest.TestCase):
+    def test_large_stderr_does_not_block(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fake_git = os.path.join(tmp_dir, "git")
+            with open(fake_git, "w", encoding="utf-8") as f:
+                f.write(f"#!{sys.executable}\n{FAKE_GIT_SCRIPT}")
+            os.chmod(fake_git, 0o755)
+
+            result = []
+            with mock.patch.object(_engine, "git_executable", lambda: fake_git):
+                # Run in a thread so a regression fails the test instead of hanging it
+                reader = threading.Thread(target=lambda: result.extend(_engine.iter_diff_files(against_head=True)), daemon=True)
+                reader.start()
+                reader.join(timeout=30)
+            self.assertFalse(reader.is_alive(), "iter_diff_files blocked on git's stderr")
+            self.assertEqual(result, ["diff --git a/x b/x\n+1\n", "diff --git a/y b/y\n+2\n"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -9,35 +9,25 @@ from io import StringIO
 from contextlib import redirect_stdout
 
 class TestGreetings(unittest.TestCase):
-    def test_print_hi(self):
-        buffer = StringIO()
-        with redirect_stdout(buffer):
-            print_hi("Jasper")
-        self.assertEqual(buffer.getvalue().strip(), "Hi, Jasper")
-
-    def test_print_good_morning(self):
-        buffer = StringIO()
-        with redirect_stdout(buffer):
-            print_good_morning("Jasper")
-        self.assertEqual(buffer.getvalue().strip(), "Good morning, Jasper")
-
-    def test_print_good_evening(self):
-        buffer = StringIO()
-        with redirect_stdout(buffer):
-            print_good_evening("Jasper")
-        self.assertEqual(buffer.getvalue().strip(), "Good evening, Jasper")
-
-    def test_motivational_quote(self):
+    def test_outputs(self):
         """
-        This test will check if the motivational quote is printed correctly.
+        This test will check that each greeting prints its expected text.
         """
-        buffer = StringIO()
-        with redirect_stdout(buffer):
-            print_motivational_quote()
-        self.assertEqual(
-            buffer.getvalue().strip(),
-            "All our dreams can come true, if we have the courage to pursue them",
-        )
+        cases = [
+            (print_hi, ("Jasper",), "Hi, Jasper"),
+            (print_good_morning, ("Jasper",), "Good morning, Jasper"),
+            (print_good_evening, ("Jasper",), "Good evening, Jasper"),
+            (
+                print_motivational_quote,
+                (),
+                "All our dreams can come true, if we have the courage to pursue them",
+            ),
+        ]
+        for function, args, expected in cases:
+            with self.subTest(function=function.__name__):
+                with redirect_stdout(buffer := StringIO()):
+                    function(*args)
+                self.assertEqual(buffer.getvalue().strip(), expected)
 
 if __name__ == "__main__":
-    unittest.main()
\ No newline at end of file
+    unittest.main()